@@ -1,4 +1,5 @@
 from private_notes import PrivNotes
+from cryptography.exceptions import InvalidTag
 
 import re
 
@@ -44,4 +45,77 @@ for title in kvs:
   if note1 != note2:
     error('get mismatch for title %s (received values %s and %s)' % (title, note1, note2))
 
+print('Trying to bulk set notes')
+bulk_kvs = { 'Todo': 'call the bank',
+             'Recipe': 'flour\nsugar\neggs',
+             'Long': 'x' * PrivNotes.MAX_NOTE_LEN }
+priv_notes.bulk_set(bulk_kvs.items())
+data, checksum = priv_notes.dump()
+bulk_instance = PrivNotes('123456', data, checksum)
+for title in bulk_kvs:
+  note = bulk_instance.get(title)
+  if note != bulk_kvs[title]:
+    error('bulk_set failed for title %s (expected %s, received %s)' % (title, bulk_kvs[title], note))
+try:
+  priv_notes.bulk_set([('Partial', 'fits'), ('Oversize', 'x' * (PrivNotes.MAX_NOTE_LEN + 1))])
+  error('bulk_set accepted a note exceeding the maximum length')
+except ValueError:
+  pass
+for title in ['Partial', 'Oversize']:
+  note = priv_notes.get(title)
+  if note is not None:
+    error('bulk_set stored title %s despite failing (received %s)' % (title, note))
+data_before, _ = priv_notes.dump()
+priv_notes.bulk_set([])
+if priv_notes.dump()[0] != data_before:
+  error('bulk_set with no items modified the database')
+
+print('Trying to rekey notes')
+old_data, old_checksum = priv_notes.dump()
+# a rekey that fails must leave the database loadable with the old password
+for bad_password in ['p\u00e4ssw\u00f6rd', None]:
+  try:
+    priv_notes.rekey(bad_password)
+    error('rekey accepted invalid password %r' % bad_password)
+  except (ValueError, TypeError):
+    pass
+  data, checksum = priv_notes.dump()
+  try:
+    failed_rekey_instance = PrivNotes('123456', data, checksum)
+  except ValueError:
+    error('database no longer opens with the old password after a failed rekey')
+  else:
+    for title in kvs:
+      note1 = priv_notes.get(title)
+      note2 = failed_rekey_instance.get(title)
+      if note1 != note2:
+        error('get mismatch after failed rekey for title %s (received values %s and %s)' % (title, note1, note2))
+priv_notes.rekey('654321')
+priv_notes.set('After rekey', 'added under the new key')
+rekey_kvs = dict(bulk_kvs)
+rekey_kvs.update(kvs)
+del rekey_kvs['Groceries']
+rekey_kvs['After rekey'] = 'added under the new key'
+data, checksum = priv_notes.dump()
+rekeyed_instance = PrivNotes('654321', data, checksum)
+for title in rekey_kvs:
+  note = rekeyed_instance.get(title)
+  if note != rekey_kvs[title]:
+    error('get failed after rekey for title %s (expected %s, received %s)' % (title, rekey_kvs[title], note))
+try:
+  PrivNotes('123456', data, checksum)
+  error('old password still opens the database after rekey')
+except ValueError:
+  pass
+# someone holding the old password and an old dump must not be able to read
+# notes from dumps made after the rekey
+old_instance = PrivNotes('123456', old_data, old_checksum)
+old_instance.kvs = rekeyed_instance.kvs
+for title in ['Idea', 'After rekey']:
+  try:
+    note = old_instance.get(title)
+    error('old key decrypted title %s after rekey (received %s)' % (title, note))
+  except InvalidTag:
+    pass
+
 print('Testing complete')
@@ -1,15 +1,167 @@
 # Authors: Christina Yi and Annie Pi
 
-import pickle
 import os
-from cryptography.hazmat.primitives import hashes, padding, hmac
-from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+import base64
+import binascii
+import functools
+import hashlib
+import hmac as stdlib_hmac
+import itertools
+import struct
+from cryptography.hazmat.primitives import hashes, hmac
+from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+from cryptography.hazmat.primitives.ciphers.aead import AESGCMSIV
+from cryptography.hazmat.primitives.keywrap import aes_key_wrap, aes_key_unwrap, InvalidUnwrap
 from cryptography.hazmat.backends import default_backend
 
 
+# KDF identifier and its (n, r, p) cost parameters; these are stored alongside
+# the salt so a database can always be reopened with the parameters it was
+# created with, even if the defaults are tuned later
+KDF_SCRYPT = 'scrypt'
+KDF_PARAMS = (KDF_SCRYPT, 2**14, 8, 1)
+
+# upper bounds on stored scrypt parameters. they come from the untrusted
+# header and are used before anything is authenticated, so a tampered
+# database must not be able to demand unbounded memory or CPU; n * r * p caps
+# the total work (and with p = 1 the memory) at 1 GiB, about 3s of scrypt
+KDF_MAX_N = 2**20
+KDF_MAX_R = 16
+KDF_MAX_P = 16
+KDF_MAX_WORK = 2**23
+
+# hash algorithm instances carry no state, so one can be shared by every HMAC
+_SHA256 = hashes.SHA256()
+
+
+def _check_kdf_params(kdf_params):
+  kdf_id, n, r, p = kdf_params
+  if (kdf_id != KDF_SCRYPT or not 2 <= n <= KDF_MAX_N or n & (n - 1)
+      or not 1 <= r <= KDF_MAX_R or not 1 <= p <= KDF_MAX_P or n * r * p > KDF_MAX_WORK):
+    raise ValueError('Malformed serialized format')
+
+
+@functools.lru_cache(maxsize=8)
+def _derive(kdf_params, password, salt):
+  # key derivation dominates the cost of constructing a PrivNotes, so memoize
+  # the source key per (params, password, salt) for the lifetime of the process
+  kdf_id, n, r, p = kdf_params
+  if kdf_id != KDF_SCRYPT:
+    raise ValueError('Unsupported key derivation function')
+  kdf = Scrypt(salt=salt, length=32, n=n, r=r, p=p, backend=default_backend())
+  return kdf.derive(password)
+
+
+# the 16 possible PKCS7 pad strings for a 16-byte block, indexed by length - 1
+_PKCS7_PADS = [bytes([n]) * n for n in range(1, 17)]
+
+
+def _pkcs7(data):
+  # PKCS7 padding to the AES block size without building the pad each call
+  return data + _PKCS7_PADS[15 - len(data) % 16]
+
+
+def _pad_note(note):
+  # pad every note to a fixed MAX_NOTE_LEN buffer behind a 2-byte length
+  # prefix so ciphertexts do not leak the length of the note
+  return len(note).to_bytes(2, 'big') + note.ljust(PrivNotes.MAX_NOTE_LEN, b'\x00')
+
+
+def _unpad_note(padded_note):
+  note_len = int.from_bytes(padded_note[:2], 'big')
+  return padded_note[2:2 + note_len]
+
+
+def _source_key_state(source_key):
+  # everything keyed by the source key, built once per key rather than per
+  # call: the cipher (so the AES key schedule only runs once), a keyed BLAKE2b
+  # state for nonces and a keyed HMAC state for checksums, both copied per use
+  return (AESGCMSIV(source_key),
+          hashlib.blake2b(digest_size=12, key=source_key),
+          hmac.HMAC(source_key, _SHA256))
+
+
+def _derive_nonce(nonce_hash, hmacd_title):
+  # derive the nonce from the title instead of storing one per title; this
+  # is safe to repeat across updates because AES-GCM-SIV is misuse-resistant
+  h = nonce_hash.copy()
+  h.update(hmacd_title)
+  return h.digest()
+
+
+# serialized layout, all integers big-endian:
+#   magic | u8 kdf_id_len | kdf_id | u32 n | u32 r | u32 p | salt (16)
+#   | wrapped_keys (72) | u32 count | count * (htitle | ct)
+# every record has the same width since htitles are SHA-256 digests and
+# notes are padded to a fixed slot, so records need no length fields
+MAGIC = b'PN1'
+SALT_LEN = 16
+KEY_LEN = 32
+# the title key and the source key are wrapped together
+WRAPPED_KEY_LEN = 2 * KEY_LEN + 8
+HTITLE_LEN = 32
+TAG_LEN = 16
+_KDF_COST = struct.Struct('>III')
+_COUNT = struct.Struct('>I')
+
+
+def _record_len():
+  return HTITLE_LEN + PrivNotes.MAX_NOTE_LEN + 2 + TAG_LEN
+
+
+def _pack_db(kdf_params, salt, wrapped_key, kvs):
+  kdf_id = bytes(kdf_params[0], 'ascii')
+  header = b''.join([MAGIC, bytes([len(kdf_id)]), kdf_id, _KDF_COST.pack(*kdf_params[1:]),
+                     salt, wrapped_key, _COUNT.pack(len(kvs))])
+  # flatten the records with a single C-level join instead of framing each one
+  return header + b''.join(itertools.chain.from_iterable(kvs.items()))
+
+
+def _unpack_header(raw):
+  # mirror of _pack_db's header; returns the KDF parameters, the salt, the
+  # wrapped key and the offset of the first record once the record area has
+  # been size-checked.
+  # any truncated or inconsistent field is a ValueError
+  try:
+    if raw[:len(MAGIC)] != MAGIC:
+      raise ValueError('Malformed serialized format')
+    offset = len(MAGIC)
+    kdf_id_len = raw[offset]
+    offset += 1
+    kdf_id = str(raw[offset:offset + kdf_id_len], 'ascii')
+    offset += kdf_id_len
+    kdf_params = (kdf_id,) + _KDF_COST.unpack_from(raw, offset)
+    _check_kdf_params(kdf_params)
+    offset += _KDF_COST.size
+    salt = raw[offset:offset + SALT_LEN]
+    offset += SALT_LEN
+    wrapped_key = raw[offset:offset + WRAPPED_KEY_LEN]
+    offset += WRAPPED_KEY_LEN
+    (count,) = _COUNT.unpack_from(raw, offset)
+    offset += _COUNT.size
+  except (IndexError, UnicodeDecodeError, struct.error):
+    raise ValueError('Malformed serialized format')
+  record_len = _record_len()
+  if (len(salt) != SALT_LEN or len(wrapped_key) != WRAPPED_KEY_LEN
+      or len(raw) - offset != count * record_len):
+    raise ValueError('Malformed serialized format')
+  return kdf_params, salt, wrapped_key, offset
+
+
+def _unpack_records(raw, offset):
+  # build the dict in one comprehension. ciphertexts are copied out as bytes,
+  # like the values set produces, so no entry keeps the whole decoded buffer
+  # alive
+  record_len = _record_len()
+  return {raw[start:start + HTITLE_LEN]: raw[start + HTITLE_LEN:start + record_len]
+          for start in range(offset, len(raw), record_len)}
+
+
 class PrivNotes:
   MAX_NOTE_LEN = 2048;
+  # the attribute set is fixed, so skip the per-instance __dict__
+  __slots__ = ('kdf_params', 'salt', 'wrapped_key', 'kvs', 'title_key', 'source_key',
+               'aesgcm', '_title_cache', '_title_hmac', '_nonce_hash', '_checksum_hmac')
   
 
   def __init__(self, password, data = None, checksum = None):
@@ -17,7 +169,7 @@ class PrivNotes:
     
     Args:
       password (str): password for accessing the notes
-      data (str) [Optional]: a hex-encoded serialized representation to load
+      data (str) [Optional]: a base64-encoded serialized representation to load
                              (defaults to None, which initializes an empty notes database)
       checksum (str) [Optional]: a hex-encoded checksum used to protect the data against
                                 possible rollback attacks
@@ -27,29 +179,51 @@ class PrivNotes:
     """
     
     if data is not None:
-      # deserialize the data first to get the salt
-      deser_data = pickle.loads(bytes.fromhex(data))
-      [self.salt, self.nonces, self.kvs] = deser_data
+      # only the header is needed to get the salt; the records are not
+      # parsed until the checksum has been verified
+      try:
+        raw = base64.b64decode(data, validate=True)
+      except (binascii.Error, ValueError):
+        raise ValueError('Malformed serialized format')
+      self.kdf_params, self.salt, self.wrapped_key, records_offset = _unpack_header(raw)
+      # now derive the password key and unwrap the title and source keys
+      password_key = _derive(self.kdf_params, bytes(password, 'ascii'), self.salt)
+      try:
+        keys = aes_key_unwrap(password_key, self.wrapped_key)
+      except InvalidUnwrap:
+        raise ValueError('Checksum is invalid, password is incorrect, or data has been tampered with.')
+      self.title_key, self.source_key = keys[:KEY_LEN], keys[KEY_LEN:]
 
     else:
-      # if no data, initialize empty database and generate a new random salt
+      # if no data, initialize empty database with a random salt, a random
+      # title key for hashing titles and a random source key for encrypting
+      # notes; both keys are stored wrapped under the password-derived key
       self.kvs = {}
-      self.nonces = {}
-      self.salt = os.urandom(16)
-        
-    # now derive the source key
-    kdf = PBKDF2HMAC(algorithm=hashes.SHA256(), length=32, salt=self.salt, 
-                     iterations=2000000, backend=default_backend()
-    )
-    self.source_key = kdf.derive(bytes(password, 'ascii'))
+      self.kdf_params = KDF_PARAMS
+      # draw the salt and both keys with a single getrandom() call
+      seed = os.urandom(SALT_LEN + 2 * KEY_LEN)
+      self.salt = seed[:SALT_LEN]
+      self.title_key, self.source_key = seed[SALT_LEN:SALT_LEN + KEY_LEN], seed[SALT_LEN + KEY_LEN:]
+      password_key = _derive(self.kdf_params, bytes(password, 'ascii'), self.salt)
+      self.wrapped_key = aes_key_wrap(password_key, self.title_key + self.source_key)
+
+    # maps plaintext titles to their HMACs so repeated accesses skip the
+    # padding and HMAC computation. only titles present in kvs are cached,
+    # so the cache never outgrows the database and misses leave no trace
+    self._title_cache = {}
+    # keyed stdlib HMAC state for titles; the inner and outer pads are hashed
+    # once here, so each new title only costs the compressions over its bytes
+    self._title_hmac = stdlib_hmac.new(self.title_key, digestmod=hashlib.sha256)
+    self.aesgcm, self._nonce_hash, self._checksum_hmac = _source_key_state(self.source_key)
 
     # if data is provided, now verify the checksum
     if data is not None:
-      h = hmac.HMAC(self.source_key, hashes.SHA256())
-      h.update(pickle.dumps([self.salt, self.nonces, self.kvs]))
-
-      if checksum != h.finalize().hex():
+      # the checksum covers the exact bytes that were loaded; compare it in
+      # constant time (compare_digest only accepts ASCII strings)
+      if (not isinstance(checksum, str) or not checksum.isascii()
+          or not stdlib_hmac.compare_digest(checksum, self._checksum(raw))):
           raise ValueError('Checksum is invalid, password is incorrect, or data has been tampered with.')
+      self.kvs = _unpack_records(raw, records_offset)
 
                                            
   def dump(self):
@@ -57,17 +231,69 @@ class PrivNotes:
        together with a checksum.
     
     Returns: 
-      data (str) : a hex-encoded serialized representation of the contents of the notes
+      data (str) : a base64-encoded serialized representation of the contents of the notes
                    database (that can be passed to the constructor)
       checksum (str) : a hex-encoded checksum for the data used to protect
-                       against rollback attacks (up to 32 characters in length)
+                       against rollback attacks (the 64-character hex of an HMAC-SHA256)
+    """
+    # return base64 data and hexified checksum
+    # use HMAC not hash, computed over the serialized bytes themselves
+    raw = _pack_db(self.kdf_params, self.salt, self.wrapped_key, self.kvs)
+    return base64.b64encode(raw).decode('ascii'), self._checksum(raw)
+
+  def rekey(self, new_password):
+    """Changes the password used to access the notes database and rotates
+       the key the notes are encrypted under. Every note is re-encrypted
+       under a fresh source key, so someone holding the old password and an
+       old dump cannot decrypt notes in later dumps or forge their checksums.
+       The title key is kept (title HMACs cannot be recomputed without the
+       titles), so they can still test whether a guessed title is present.
+
+       Args:
+         new_password (str) : the new password for accessing the notes
+
+       Returns:
+         None
     """
-    # return hexified data and checksum
-    # use HMAC not hash
-    # expand data to involve everything self needs to store
-    ser_data = [self.salt, self.nonces, self.kvs]
-    deser_data = pickle.dumps(ser_data).hex()
-    return deser_data, hmac.HMAC(self.source_key, hashes.SHA256()).hex()
+    # build the whole new state in locals and only assign it once every step
+    # has succeeded, so a bad password or a failure part way through leaves
+    # the database as it was
+
+    # draw the new salt and source key with a single getrandom() call
+    seed = os.urandom(SALT_LEN + KEY_LEN)
+    salt, source_key = seed[:SALT_LEN], seed[SALT_LEN:]
+    # derive the new password key first; this moves the database onto the
+    # current default KDF parameters
+    password_key = _derive(KDF_PARAMS, bytes(new_password, 'ascii'), salt)
+    aesgcm, nonce_hash, checksum_hmac = _source_key_state(source_key)
+    # re-encrypt every note under the new source key
+    kvs = {}
+    for hmacd_title, note in self.kvs.items():
+      padded_note = self.aesgcm.decrypt(self._nonce(hmacd_title), note, None)
+      kvs[hmacd_title] = aesgcm.encrypt(_derive_nonce(nonce_hash, hmacd_title), padded_note, None)
+    wrapped_key = aes_key_wrap(password_key, self.title_key + source_key)
+
+    self.kdf_params, self.salt, self.source_key, self.wrapped_key = KDF_PARAMS, salt, source_key, wrapped_key
+    self.aesgcm, self._nonce_hash, self._checksum_hmac = aesgcm, nonce_hash, checksum_hmac
+    self.kvs = kvs
+
+  def _checksum(self, raw):
+    h = self._checksum_hmac.copy()
+    h.update(raw)
+    return h.finalize().hex()
+
+  def _htitle(self, title):
+    # pad and hmac the (already encoded) title under the title key; callers
+    # add the result to _title_cache once the title is known to be in kvs
+    hmacd_title = self._title_cache.get(title)
+    if hmacd_title is None:
+      h = self._title_hmac.copy()
+      h.update(_pkcs7(title))
+      hmacd_title = h.digest()
+    return hmacd_title
+
+  def _nonce(self, hmacd_title):
+    return _derive_nonce(self._nonce_hash, hmacd_title)
 
   def get(self, title):
     """Fetches the note associated with a title.
@@ -79,19 +305,21 @@ class PrivNotes:
       note (str) : the note associated with the requested title if
                        it exists and otherwise None
     """
+    note = self._get_bytes(bytes(title, 'ascii'))
+    # now change it to ASCII string
+    return None if note is None else note.decode('ascii')
+
+  def _get_bytes(self, title):
+    # get for callers that already hold the title as bytes
     # first, pad and hmac title
-    padder = padding.PKCS7(16384).padder()
-    unpadder = padding.PKCS7(16384).unpadder()
-    hmacd_title = hmac.HMAC(padder.update(title) + padder.finalize(), hashes.SHA256())
-    if hmacd_title in self.nonces:
-      note = self.kvs[hmacd_title]
-      aesgcm = AESGCM(self.source_key)
-      decrypted_note = aesgcm.decrypt(self.nonces[hmacd_title], note, None)
-      unpadded_note = unpadder.update(decrypted_note) + unpadder.finalize()
-      # now change it to ASCII string
-      note = unpadded_note.decode('ascii')
-      return note
-    return None
+    hmacd_title = self._htitle(title)
+    note = self.kvs.get(hmacd_title)
+    # bail out on a miss before deriving the nonce or touching the cipher
+    if note is None:
+      return None
+    self._title_cache[title] = hmacd_title
+    decrypted_note = self.aesgcm.decrypt(self._nonce(hmacd_title), note, None)
+    return _unpad_note(decrypted_note)
 
 
   def set(self, title, note):
@@ -109,20 +337,43 @@ class PrivNotes:
        Raises:
          ValueError : if note length exceeds the maximum
     """
+    self._set_bytes(bytes(title, 'ascii'), bytes(note, 'ascii'))
+
+  def _set_bytes(self, title, note):
+    # set for callers that already hold the title and note as bytes
     if len(note) > self.MAX_NOTE_LEN:
       raise ValueError('Maximum note length exceeded') 
-    padder = padding.PKCS7(16384).padder()
     # Pad and hash the title, pad the note
-    hmacd_title = hmac.HMAC(padder.update(title) + padder.finalize(), hashes.SHA256())
-    padded_note = padder.update(note) + padder.finalize()
+    hmacd_title = self._htitle(title)
+    padded_note = _pad_note(note)
     # encrypt the note and store the pair in kvs
-    aesgcm = AESGCM(self.source_key)
-    if hmacd_title in self.nonces:
-      nonce = self.nonces[hmacd_title]
-    else:
-      nonce = os.urandom(16)
-      self.nonces[hmacd_title] = nonce
-    self.kvs[hmacd_title] = aesgcm.encrypt(nonce, padded_note, None)
+    nonce = self._nonce(hmacd_title)
+    self.kvs[hmacd_title] = self.aesgcm.encrypt(nonce, padded_note, None)
+    self._title_cache[title] = hmacd_title
+
+
+  def bulk_set(self, items):
+    """Associates many notes with their titles at once, as if set were
+       called for each pair. Every note is checked before the database
+       is modified, so either all of the notes are stored or none are.
+
+       Args:
+         items (list of (str, str)) : the (title, note) pairs to set
+
+       Returns:
+         None
+
+       Raises:
+         ValueError : if any note length exceeds the maximum
+    """
+    # encode and check everything before storing anything, so a bad note
+    # leaves the database untouched
+    items = [(bytes(title, 'ascii'), bytes(note, 'ascii')) for title, note in items]
+    for _, note in items:
+      if len(note) > self.MAX_NOTE_LEN:
+        raise ValueError('Maximum note length exceeded')
+    for title, note in items:
+      self._set_bytes(title, note)
 
 
   def remove(self, title):
@@ -135,11 +386,9 @@ class PrivNotes:
          success (bool) : True if the title was removed and False if the title was
                           not found
     """
-    padder = padding.PKCS7(16384).padder()
-    hmacd_title = hmac.HMAC(padder.update(title) + padder.finalize(), hashes.SHA256())
-    if hmacd_title in self.nonces:
-      del self.kvs[hmacd_title]
-      return True
-    # return false if hmaced_title is not in nonces, because this means 
-    # the title is not in kvs
-    return False
+    title = bytes(title, 'ascii')
+    hmacd_title = self._htitle(title)
+    # forget the title along with its note; a single pop both tests for and
+    # removes the entry
+    self._title_cache.pop(title, None)
+    return self.kvs.pop(hmacd_title, None) is not None